@@ -2,40 +2,51 @@
 # app.py — main entry point for Flask server
 
 import time
+import heapq
+import hashlib
+import itertools
 import threading
 import logging
 import atexit
-import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from flask import Flask, jsonify, request, Response, stream_with_context
+from secrets import token_urlsafe
+from flask import Flask, request, Response, stream_with_context, g
 from flask_cors import CORS
+import orjson
 import paho.mqtt.client as mqtt
+from waitress import serve
 
 # Local modules
 from led import setup_led, cleanup_led, led_on, led_off
-from camera import mjpeg_generator
-from storage import create_presigned_upload_url, create_presigned_view_url, list_s3_objects
+from camera import get_camera, mjpeg_generator, take_snapshot, STREAM_FPS
+from storage import create_presigned_upload_url, create_presigned_view_url, cached_s3_pages, invalidate_listings, presign_get
+from storage import s3 as _s3, S3_BUCKET
 
 # ===== Flask setup =====
 app = Flask(__name__)
 CORS(app)
 
+def _json(obj):
+    """JSON response serialized straight to bytes by orjson (no jsonify round trip)."""
+    return Response(orjson.dumps(obj), mimetype="application/json")
+
+def body():
+    """Parsed JSON request body, cached per request; {} when empty or invalid."""
+    if not hasattr(g, "_body"):
+        raw = request.get_data(cache=False)
+        try:
+            g._body = orjson.loads(raw) if raw else {}
+        except orjson.JSONDecodeError:
+            g._body = {}
+    return g._body
+
 # Setup logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 log = logging.getLogger("pi_server")
 
-# Filter out health check requests from Werkzeug logger
-class HealthCheckFilter(logging.Filter):
-    def filter(self, record):
-        # Suppress logs for /health endpoint
-        return "/health" not in record.getMessage()
-
-# Apply filter to Werkzeug logger (Flask's request logger)
-werkzeug_logger = logging.getLogger("werkzeug")
-werkzeug_logger.addFilter(HealthCheckFilter())
-
-# LED will be initialized in main() function
+# LED, MQTT and the watchdog thread are started by _init() from main()
 
 # ===== Device Management & MQTT Configuration =====
 DEVICES_FILE = "/home/anders/smarthome/devices.json"
@@ -69,159 +80,344 @@ def _cleanup_mqtt():
         except Exception as e:
             log.error(f"Error disconnecting MQTT client: {e}")
 
+# devices.json is small and rarely changes: keep the parsed list and only
+# re-read the file when its mtime changes
+_devices_cache = None
+_devices_mtime = None
+_devices_lock = threading.Lock()
+
 def load_devices():
     """Load device list from JSON file"""
-    if not os.path.exists(DEVICES_FILE):
-        return []
+    global _devices_cache, _devices_mtime
     try:
-        with open(DEVICES_FILE, "r") as f:
-            return json.load(f)
-    except Exception as e:
-        log.error(f"Error loading devices: {e}")
+        mtime = os.stat(DEVICES_FILE).st_mtime_ns
+    except OSError:
         return []
+    with _devices_lock:
+        # Copies, so callers can't mutate the cached list
+        if mtime == _devices_mtime:
+            return list(_devices_cache)
+        try:
+            with open(DEVICES_FILE, "rb") as f:
+                devices = orjson.loads(f.read())
+        except Exception as e:
+            log.error(f"Error loading devices: {e}")
+            return []
+        _devices_cache = devices
+        _devices_mtime = mtime
+        return list(devices)
 
 def save_devices(devices):
     """Save device list to JSON file"""
-    try:
-        with open(DEVICES_FILE, "w") as f:
-            json.dump(devices, f, indent=2)
-        log.info(f"Saved {len(devices)} devices to {DEVICES_FILE}")
-    except Exception as e:
-        log.error(f"Error saving devices: {e}")
-        raise
+    global _devices_cache, _devices_mtime
+    with _devices_lock:
+        try:
+            with open(DEVICES_FILE, "wb") as f:
+                f.write(orjson.dumps(devices, option=orjson.OPT_INDENT_2))
+            _devices_cache = devices
+            _devices_mtime = os.stat(DEVICES_FILE).st_mtime_ns
+            log.info(f"Saved {len(devices)} devices to {DEVICES_FILE}")
+        except Exception as e:
+            log.error(f"Error saving devices: {e}")
+            raise
 
 # ===== Session tracking for camera streams =====
 _stream_sessions = {}
 _stream_lock = threading.Lock()
+_watchdog_cv = threading.Condition(_stream_lock)  # Notified when sessions come and go
+_deadline_heap = []  # (deadline, session_id), rescheduled lazily when popped
 _led_state = False  # Track LED state globally
+# Kept in step with _stream_sessions (under _stream_lock) so state queries
+# never have to scan the sessions
+_active_session_count = 0
+_led_owner_count = 0  # Sessions that hold the LED on
 
 def _create_session():
     """Create a new unique streaming session."""
-    import uuid
-    sid = str(uuid.uuid4())
-    with _stream_lock:
+    global _active_session_count
+    sid = token_urlsafe(9)  # 12 URL-safe chars
+    with _watchdog_cv:
         _stream_sessions[sid] = {
-            "created": time.time(),
-            "last_yield": None,
-            "active": True,
+            "created": time.monotonic(),
+            "last_yield": [None],  # Mutated in place by the frame callback
+            "stop": threading.Event(),  # Set to stop the stream
             "led_on": False
         }
+        _active_session_count += 1
+        heapq.heappush(_deadline_heap, (_session_deadline(_stream_sessions[sid]), sid))
+        _watchdog_cv.notify()
     return sid
 
 def _stop_session(sid):
     """Stop a specific session and turn off LED if no sessions remain."""
-    global _led_state
-    with _stream_lock:
-        if sid in _stream_sessions:
-            _stream_sessions[sid]["active"] = False
-            if _stream_sessions[sid].get("led_on"):
-                _force_led_off()
-                log.info(f"LED turned off for session {sid}")
-            del _stream_sessions[sid]
-            log.info(f"Stopped stream session: {sid}")
-
-        # Always turn off LED when stopping a session
-        _force_led_off()
+    global _active_session_count, _led_owner_count
+    # Only dict/counter updates under the lock; LED and logging happen after
+    with _watchdog_cv:
+        session = _stream_sessions.pop(sid, None)
+        if session is not None:
+            if not session["stop"].is_set():
+                session["stop"].set()
+                _active_session_count -= 1
+            if session.get("led_on"):
+                _led_owner_count -= 1
+            _watchdog_cv.notify()
+
+    if session is not None:
+        if session.get("led_on"):
+            log.info(f"LED turned off for session {sid}")
+        log.info(f"Stopped stream session: {sid}")
+
+    # Always turn off LED when stopping a session
+    _force_led_off()
+
+# GPIO writes run on a single LED thread so request threads never wait on
+# them. Callers set the desired state; the thread drives the pin only when
+# it differs from what was last written, so rapid on/off/on collapses.
+_led_exec = ThreadPoolExecutor(max_workers=1, thread_name_prefix="led")
+_led_desired = False
+_led_hw = False  # Last state written to the pin (setup_led starts it off)
+# At most one capture flash waits in the queue; captures during it share it
+_flash_pending = False
+_flash_lock = threading.Lock()
+
+def _apply_led():
+    """Drive the LED to the desired state (runs on the LED thread)"""
+    global _led_hw
+    time.sleep(0.005)  # Let rapid toggles settle before touching the pin
+    desired = _led_desired
+    if desired == _led_hw:
+        return
+    try:
+        if desired:
+            led_on()
+        else:
+            led_off()
+        _led_hw = desired
+    except Exception as e:
+        log.error(f"Failed to turn {'on' if desired else 'off'} LED: {e}")
+
+def _set_led(state):
+    """Record the desired LED state and let the LED thread apply it"""
+    global _led_state, _led_desired
+    _led_desired = state
+    _led_state = state
+    _led_exec.submit(_apply_led)
 
 def _force_led_off():
     """Force LED off and update state"""
-    global _led_state
-    try:
-        led_off()
-        _led_state = False
-    except Exception as e:
-        log.error(f"Failed to turn off LED: {e}")
+    _set_led(False)
 
 def _force_led_on():
     """Force LED on and update state"""
-    global _led_state
+    _set_led(True)
+
+def _do_flash():
+    """Flash off-on-off, then restore the desired state (runs on the LED thread)"""
+    global _led_hw, _flash_pending
+    with _flash_lock:
+        _flash_pending = False
     try:
+        led_off()
+        time.sleep(0.1)
         led_on()
-        _led_state = True
+        time.sleep(0.1)
+        led_off()
+        time.sleep(0.1)
+        _led_hw = False
     except Exception as e:
-        log.error(f"Failed to turn on LED: {e}")
+        log.error(f"Failed to flash LED: {e}")
+        _led_hw = None  # Unknown; force the next apply to write
+    _apply_led()
 
 def _flash_led_for_capture():
-    """Flash LED for capture, then restore to stream state if streaming"""
-    global _led_state
-    was_streaming = any(s.get("led_on", False) for s in _stream_sessions.values())
-    
-    # Flash off-on-off
-    led_off()
-    time.sleep(0.1)
-    led_on()
-    time.sleep(0.1)
-    led_off()
-    time.sleep(0.1)
-    
-    # Restore LED state based on streaming status
-    if was_streaming:
-        led_on()
-        _led_state = True
-    else:
-        _led_state = False
+    """Flash LED for capture, then restore to stream state if streaming.
+
+    Returns immediately; the flash runs on the LED thread. A capture that
+    arrives while a flash is still queued is covered by that flash.
+    """
+    global _led_state, _led_desired, _flash_pending
+    was_streaming = _led_owner_count > 0
+    _led_desired = was_streaming
+    _led_state = was_streaming
+    with _flash_lock:
+        if _flash_pending:
+            return
+        _flash_pending = True
+    _led_exec.submit(_do_flash)
+
+def _session_deadline(session):
+    """When a session goes stale: 5 s to the first frame, then 3 s between frames."""
+    last_yield = session["last_yield"][0]
+    if last_yield is None:
+        return session["created"] + 5.0
+    return last_yield + 3.0
 
 def _cleanup_stale_sessions():
-    """Clean up sessions that haven't yielded frames in 3 seconds"""
-    current_time = time.time()
+    """Clean up sessions that haven't yielded frames in 3 seconds.
+
+    Only sessions whose heap deadline has passed are looked at; a session
+    that yielded since it was queued is pushed back with its new deadline.
+    Returns seconds until the next deadline, or None when the heap is empty.
+    """
+    now = time.monotonic
+    current_time = now()
     stale_sessions = []
     
+    # Take the lock only to pop due entries; deadlines are evaluated without it
+    due = []
     with _stream_lock:
-        for session_id, session in _stream_sessions.items():
-            if session["active"]:
-                # Clean up sessions that never yielded (last_yield is None) and are older than 5 seconds
-                if session["last_yield"] is None and (current_time - session["created"] > 5.0):
-                    log.warning(f"Cleaning up session {session_id} - never yielded frames after 5 seconds")
-                    _stop_session(session_id)
-                    stale_sessions.append(session_id)
-                # Clean up sessions that yielded but haven't yielded in 3 seconds
-                elif session["last_yield"] and (current_time - session["last_yield"] > 3.0):
-                    log.warning(f"Cleaning up stale session {session_id} - no activity for 3+ seconds")
-                    _stop_session(session_id)
-                    stale_sessions.append(session_id)
-        
-        # Remove stale sessions from tracking
-        for session_id in stale_sessions:
-            if session_id in _stream_sessions:
-                del _stream_sessions[session_id]
-        
-        # If we cleaned up sessions, force LED off
-        if stale_sessions:
-            _force_led_off()
-            log.info(f"Cleaned up {len(stale_sessions)} stale sessions and forced LED off")
+        while _deadline_heap and _deadline_heap[0][0] <= current_time:
+            _, session_id = heapq.heappop(_deadline_heap)
+            session = _stream_sessions.get(session_id)
+            if session is not None:  # Otherwise already stopped
+                due.append((session_id, session))
+    
+    rescheduled = []
+    for session_id, session in due:
+        deadline = _session_deadline(session)
+        if deadline <= current_time:
+            stale_sessions.append(session_id)
+        else:
+            rescheduled.append((deadline, session_id))
+    
+    with _stream_lock:
+        for entry in rescheduled:
+            if entry[1] in _stream_sessions:
+                heapq.heappush(_deadline_heap, entry)
+        next_deadline = _deadline_heap[0][0] if _deadline_heap else None
+    
+    # Stop outside the scan; _stop_session takes _stream_lock itself
+    for session_id in stale_sessions:
+        log.warning(f"Cleaning up stale session {session_id} - no frames within timeout")
+        _stop_session(session_id)
+    
+    # If we cleaned up sessions, force LED off
+    if stale_sessions:
+        _force_led_off()
+        log.info(f"Cleaned up {len(stale_sessions)} stale sessions and forced LED off")
+    
+    if next_deadline is None:
+        return None
+    return max(0.0, next_deadline - now())
 
 def _watchdog_loop():
-    """Background thread to clean up stale sessions"""
+    """Background thread to clean up stale sessions.
+
+    Sleeps until the next session deadline, or indefinitely while there are
+    no sessions; _create_session wakes it up.
+    """
     while True:
-        _cleanup_stale_sessions()
-        time.sleep(2)  # Check every 2 seconds
+        timeout = _cleanup_stale_sessions()
+        with _watchdog_cv:
+            if timeout is None:
+                while not _deadline_heap:
+                    _watchdog_cv.wait()
+            else:
+                _watchdog_cv.wait(timeout=timeout)
+
+# ===== Background S3 uploads =====
+# Bounded so a slow network rejects new uploads (503) instead of piling
+# JPEGs up in memory.
+UPLOAD_QUEUE_MAX = 32
+_upload_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="s3-upload")
+_upload_lock = threading.Lock()
+_upload_pending = 0
+
+def _reserve_upload_slot():
+    """Reserve a place in the upload queue; False if the queue is full."""
+    global _upload_pending
+    with _upload_lock:
+        if _upload_pending >= UPLOAD_QUEUE_MAX:
+            return False
+        _upload_pending += 1
+        return True
+
+def _release_upload_slot():
+    global _upload_pending
+    with _upload_lock:
+        _upload_pending -= 1
+        return _upload_pending
+
+def _upload_done(future, key):
+    """Log the result of a background upload and free its queue slot."""
+    pending = _release_upload_slot()
+    exc = future.exception()
+    if exc:
+        log.error(f"S3 upload failed for {key}: {exc}")
+    else:
+        invalidate_listings(key)
+        log.info(f"S3 upload finished for {key} ({pending} pending)")
 
-# Start watchdog thread
-threading.Thread(target=_watchdog_loop, daemon=True).start()
+def _submit_upload(key, body, content_type):
+    """Run put_object on the upload pool. Caller must hold a reserved slot."""
+    future = _upload_pool.submit(
+        _s3.put_object, Bucket=S3_BUCKET, Key=key, Body=body, ContentType=content_type
+    )
+    future.add_done_callback(lambda f: _upload_done(f, key))
+    log.info(f"Queued S3 upload for {key} ({_upload_pending} pending)")
 
 # ====== Routes ======
 
+# /health is polled constantly; its body never changes
+_HEALTH_BODY = orjson.dumps({"status": "ok"})
+
 @app.route("/health", methods=["GET"])
 def health():
-    return jsonify({"status": "ok"})
+    return Response(_HEALTH_BODY, mimetype="application/json", headers={"Cache-Control": "no-store"})
 
 @app.route("/s3/upload-url", methods=["POST"])
 def s3_upload_url():
-    data = request.get_json(force=True, silent=True) or {}
-    return jsonify(create_presigned_upload_url(data))
+    data = body()
+    return _json(create_presigned_upload_url(data))
 
 @app.route("/s3/view-url", methods=["POST"])
 def s3_view_url():
-    data = request.get_json(force=True)
-    return jsonify(create_presigned_view_url(data))
+    data = body()
+    try:
+        result = create_presigned_view_url(data)
+    except ValueError as e:
+        return _json({"error": str(e)}), 400
+    resp = _json(result)
+    # Let the client reuse the URL until shortly before it actually expires
+    max_age = max(0, result["expiresAt"] - int(time.time()) - 60)
+    resp.headers["Cache-Control"] = f"private, max-age={max_age}"
+    return resp
 
 @app.route("/s3/list", methods=["GET"])
 def s3_list():
+    """Stream the listing page by page instead of building the whole list first"""
     prefix = request.args.get("prefix", "users/")
-    return jsonify(list_s3_objects(prefix))
+    pages = cached_s3_pages(prefix)
+    first = next(pages)  # Fetch eagerly so S3 errors still become a 500
+
+    def gen():
+        yield b'{"items":['
+        sep = b""
+        truncated = False
+        for page in itertools.chain((first,), pages):
+            for item in page["items"]:
+                yield sep + orjson.dumps(item)
+                sep = b","
+            truncated = page["truncated"]
+        yield b'],"truncated":' + (b"true" if truncated else b"false") + b"}"
+
+    return Response(
+        stream_with_context(gen()),
+        mimetype="application/json",
+        # The server already caches listings; always revalidate so uploads show up
+        headers={"Cache-Control": "no-cache"},
+    )
 
 @app.route('/camera/stream', methods=['GET'])
 def camera_stream():
+    global _active_session_count
+    # Fail fast if the camera can't be opened - before any session or LED state exists
+    try:
+        get_camera()
+    except Exception as e:
+        log.error(f"Camera stream unavailable: {e}")
+        return _json({"error": "Camera not available", "message": str(e)}), 503
+    
     # Get or create session ID
     session_id = request.args.get('session_id')
     if not session_id:
@@ -230,26 +426,43 @@ def camera_stream():
     else:
         # Resume existing session
         if session_id not in _stream_sessions:
-            return jsonify({"error": "Invalid session ID"}), 400
-        _stream_sessions[session_id]["active"] = True
+            return _json({"error": "Invalid session ID"}), 400
         log.info(f"Resumed stream session: {session_id}")
     
-    # Turn on LED for this session
-    _force_led_on()
-    _stream_sessions[session_id]["led_on"] = True
+    with _stream_lock:
+        session = _stream_sessions.get(session_id)
+        if session is None:
+            return _json({"error": "Invalid session ID"}), 400
+        if session["stop"].is_set():
+            session["stop"].clear()
+            _active_session_count += 1
+    last_yield = session["last_yield"]
+
+    def _claim_led():
+        """Turn on LED for this session once its first frame is ready"""
+        global _led_owner_count
+        with _stream_lock:
+            if _stream_sessions.get(session_id) is not session or session["led_on"]:
+                return
+            session["led_on"] = True
+            _led_owner_count += 1
+        _force_led_on()
+
+    def _on_frame_session():
+        """Update session timestamp when frame is yielded"""
+        last_yield[0] = time.monotonic()
 
     def gen():
-        def should_continue():
-            """Check if the session is still active - this stops the camera from generating frames"""
-            return session_id in _stream_sessions and _stream_sessions[session_id]["active"]
-        
         try:
+            # The session's stop Event ends the generator, even while it waits between frames
             for frame in mjpeg_generator(
-                target_fps=8, 
+                target_fps=STREAM_FPS,
                 quality=80, 
-                on_frame=lambda: _on_frame_session(session_id),
-                should_continue=should_continue
+                on_frame=_on_frame_session,
+                stop_event=session["stop"]
             ):
+                if not session["led_on"]:
+                    _claim_led()
                 # Try to yield the frame - this will raise an exception if client disconnected
                 try:
                     yield frame
@@ -264,14 +477,9 @@ def camera_stream():
         except Exception as e:
             log.warning(f"Unexpected exception in stream generator for session {session_id}: {e}")
         finally:
-            # Clean up session
+            # Clean up session - this also turns the LED off
             _stop_session(session_id)
 
-    def _on_frame_session(sid):
-        """Update session timestamp when frame is yielded"""
-        if sid in _stream_sessions:
-            _stream_sessions[sid]["last_yield"] = time.time()
-
     # Create response
     resp = Response(
         stream_with_context(gen()),
@@ -279,7 +487,7 @@ def camera_stream():
         headers={
             "Cache-Control": "no-store, no-cache, must-revalidate, max-age=0",
             "Pragma": "no-cache",
-            "Connection": "close",
+            "X-Accel-Buffering": "no",  # Keep reverse proxies from buffering the stream
             "X-Session-ID": session_id,  # Include session ID in response headers
         },
     )
@@ -289,82 +497,99 @@ def camera_stream():
 @app.route("/camera/stream/stop", methods=["POST"])
 def stop_camera_stream():
     """Stop all active camera streams and turn off LED"""
+    global _active_session_count, _led_owner_count
     with _stream_lock:
         stopped_count = 0
         
         # First, mark all sessions as inactive to stop camera generation
         for session_id in list(_stream_sessions.keys()):
-            if _stream_sessions[session_id]["active"]:
-                _stream_sessions[session_id]["active"] = False
+            if not _stream_sessions[session_id]["stop"].is_set():
+                _stream_sessions[session_id]["stop"].set()
                 stopped_count += 1
         
         # Clear all sessions immediately
         _stream_sessions.clear()
-        
-        # Force LED off regardless
-        _force_led_off()
-    return jsonify({"status": "stopped", "sessions_stopped": stopped_count, "led_state": _led_state})
+        _deadline_heap.clear()
+        _active_session_count = 0
+        _led_owner_count = 0
+    
+    # Force LED off regardless
+    _force_led_off()
+    return _json({"status": "stopped", "sessions_stopped": stopped_count, "led_state": _led_state})
 
 @app.route("/camera/stream/state", methods=["GET"])
 def camera_stream_state():
     """Get the current state of camera streams"""
-    with _stream_lock:
-        active_sessions = len([s for s in _stream_sessions.values() if s["active"]])
-        return jsonify({
-            "streaming": active_sessions > 0,
-            "active_sessions": active_sessions,
-            "led_on": any(s.get("led_on", False) for s in _stream_sessions.values())
-        })
+    active_sessions = _active_session_count
+    return _json({
+        "streaming": active_sessions > 0,
+        "active_sessions": active_sessions,
+        "led_on": _led_owner_count > 0
+    })
+
+# Snapshots requested within one stream frame interval share a capture
+SNAPSHOT_MIN_INTERVAL = 0.125
+_last_snap = None  # (monotonic time, jpeg bytes, etag)
+_snap_lock = threading.Lock()
+
+def _recent_snapshot():
+    """Return (jpeg, etag), capturing a new one only if the last is too old"""
+    global _last_snap
+    with _snap_lock:
+        now = time.monotonic()
+        ls = _last_snap
+        if ls and now - ls[0] < SNAPSHOT_MIN_INTERVAL:
+            return ls[1], ls[2]
+        # Flash LED before taking snapshot
+        _flash_led_for_capture()
+        jpg = take_snapshot(quality=90)
+        etag = hashlib.blake2b(jpg, digest_size=8).hexdigest()
+        _last_snap = (now, jpg, etag)
+        return jpg, etag
 
 @app.route("/camera/snapshot", methods=["GET"])
 def camera_snapshot():
     try:
-        from camera import take_snapshot
-        # Flash LED before taking snapshot
-        _flash_led_for_capture()
-        image_bytes = take_snapshot(quality=90)
-        return Response(image_bytes, mimetype="image/jpeg", headers={"Cache-Control": "no-store"})
+        image_bytes, etag = _recent_snapshot()
+        headers = {"Cache-Control": "no-cache", "ETag": f'"{etag}"'}
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers=headers)
+        return Response(image_bytes, mimetype="image/jpeg", headers=headers)
     except Exception as e:
         log.error(f"Camera snapshot failed: {e}")
-        return jsonify({"error": "Camera not available", "message": str(e)}), 500
+        return _json({"error": "Camera not available", "message": str(e)}), 500
 
 @app.route("/camera/upload", methods=["POST"])
 def camera_upload():
-    """Take a snapshot and upload it to S3, return the S3 URLs"""
-    from camera import take_snapshot
-    import boto3
-    import uuid
-    
-    # Flash LED before taking snapshot
-    _flash_led_for_capture()
+    """Take a snapshot and queue it for upload to S3, return the S3 URLs"""
+    if not _reserve_upload_slot():
+        return _json({"error": "Upload queue full, try again later"}), 503
     
-    # Take snapshot
-    image_bytes = take_snapshot(quality=90)
+    try:
+        # Flash LED before taking snapshot
+        _flash_led_for_capture()
+        
+        # Take snapshot
+        image_bytes = take_snapshot(quality=90)
+    except Exception:
+        _release_upload_slot()
+        raise
     
     # Generate S3 key with human-readable timestamp + short session ID
     timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    session_id = request.headers.get("X-Session-Id", str(uuid.uuid4())[:6])
+    session_id = request.headers.get("X-Session-Id") or token_urlsafe(4)  # 6 chars
     filename = f"photo_{timestamp}_{session_id}.jpg"
     user_id = request.headers.get("X-User-Id", "anon")
     key = f"users/{user_id}/{filename}"
     
-    # Upload to S3
-    s3 = boto3.client("s3", region_name="eu-north-1")
-    s3.put_object(
-        Bucket="pi-photos-bucket",
-        Key=key,
-        Body=image_bytes,
-        ContentType="image/jpeg"
-    )
+    # Upload to S3 in the background
+    _submit_upload(key, image_bytes, "image/jpeg")
     
-    # Generate view URL
-    view_url = s3.generate_presigned_url(
-        ClientMethod="get_object",
-        Params={"Bucket": "pi-photos-bucket", "Key": key},
-        ExpiresIn=3600,
-    )
+    # Generate view URL for the object once the upload lands
+    view_url, _ = presign_get(key)
     
-    return jsonify({
+    # Same contract as before the upload moved to the background
+    return _json({
         "status": "uploaded",
         "key": key,
         "viewUrl": view_url
@@ -375,22 +600,22 @@ def camera_upload():
 def control_led():
     """Manually control LED on/off"""
     try:
-        data = request.get_json() or {}
+        data = body()
         state = (data.get('state') or '').lower()
         if state == 'on':
             _force_led_on()
-            return jsonify({"status": "success", "message": "LED turned on", "led_state": _led_state})
+            return _json({"status": "success", "message": "LED turned on", "led_state": _led_state})
         else:
             _force_led_off()
-            return jsonify({"status": "success", "message": "LED turned off", "led_state": _led_state})
+            return _json({"status": "success", "message": "LED turned off", "led_state": _led_state})
     except Exception as e:
         log.error(f"Error controlling LED: {e}")
-        return jsonify({"status": "error", "message": f"Failed to control LED: {str(e)}", "led_state": _led_state}), 500
+        return _json({"status": "error", "message": f"Failed to control LED: {str(e)}", "led_state": _led_state}), 500
 
 @app.route("/led/status", methods=["GET"])
 def led_status():
     """Get current LED status"""
-    return jsonify({"led_on": _led_state, "active_sessions": len(_stream_sessions)})
+    return _json({"led_on": _led_state, "active_sessions": len(_stream_sessions)})
 
 @app.route("/brightness", methods=["POST", "OPTIONS"])
 def brightness_control():
@@ -398,19 +623,19 @@ def brightness_control():
     if request.method == "OPTIONS":
         return "", 200
     
-    data = request.get_json() or {}
+    data = body()
     brightness = data.get('brightness', 100)
     
     # For now, just return success since we don't have brightness control
     # You could implement PWM brightness control here if needed
-    return jsonify({"status": "success", "brightness": brightness})
+    return _json({"status": "success", "brightness": brightness})
 
 # ====== Device Management ======
 @app.route("/api/devices", methods=["GET"])
 def get_devices():
     """Get list of devices from JSON file"""
     devices = load_devices()
-    return jsonify(devices)
+    return _json(devices)
 
 @app.route("/api/devices", methods=["POST"])
 def update_devices():
@@ -422,20 +647,20 @@ def update_devices():
     ]
     """
     try:
-        data = request.get_json(force=True)
+        data = body()
         if not isinstance(data, list):
-            return jsonify({"error": "Data must be a list"}), 400
+            return _json({"error": "Data must be a list"}), 400
         
         # Validate each device
         for d in data:
             if "name" not in d or "ip" not in d:
-                return jsonify({"error": "Each device must have 'name' and 'ip' fields"}), 400
+                return _json({"error": "Each device must have 'name' and 'ip' fields"}), 400
         
         save_devices(data)
-        return jsonify({"status": "ok", "count": len(data)})
+        return _json({"status": "ok", "count": len(data)})
     except Exception as e:
         log.error(f"Error updating devices: {e}")
-        return jsonify({"error": str(e)}), 500
+        return _json({"error": str(e)}), 500
 
 # ====== AC Control ======
 @app.route("/api/ac", methods=["POST"])
@@ -444,25 +669,35 @@ def control_ac():
     Control AC via MQTT. Body: { "action": "on" } or { "action": "off" }
     """
     try:
-        data = request.get_json(force=True)
+        data = body()
         action = data.get("action")
         
         if action not in ("on", "off"):
-            return jsonify({"error": "action must be 'on' or 'off'"}), 400
+            return _json({"error": "action must be 'on' or 'off'"}), 400
         
         if not mqtt_client:
-            return jsonify({"error": "MQTT client not connected"}), 503
+            return _json({"error": "MQTT client not connected"}), 503
         
         mqtt_client.publish(TOPIC_CMD, action)
         log.info(f"Published AC command: {action} to topic {TOPIC_CMD}")
-        return jsonify({"status": "sent", "action": action})
+        return _json({"status": "sent", "action": action})
     except Exception as e:
         log.error(f"Error controlling AC: {e}")
-        return jsonify({"error": str(e)}), 500
+        return _json({"error": str(e)}), 500
 
 # ====== Main ======
-def main():
-    log.info("🚀 Starting Flask Pi Server...")
+_initialized = False
+
+def _init():
+    """Start hardware, MQTT and background threads; runs once per process.
+
+    Kept out of import time so importing app (tools, tests, a WSGI server
+    loading app:app) never touches GPIO or starts threads by itself.
+    """
+    global _initialized
+    if _initialized:
+        return
+    _initialized = True
     
     # Initialize LED
     setup_led()
@@ -470,11 +705,23 @@ def main():
     # Initialize MQTT client
     _init_mqtt()
     
+    # Start watchdog thread
+    threading.Thread(target=_watchdog_loop, daemon=True).start()
+    
     # Register cleanup handlers
     atexit.register(_cleanup_mqtt)
     atexit.register(cleanup_led)
+
+def main():
+    log.info("🚀 Starting Flask Pi Server...")
+    _init()
     
-    app.run(host="0.0.0.0", port=5000, debug=True, threaded=True, use_reloader=False)
+    # Waitress instead of the Werkzeug dev server: a fixed thread pool, no
+    # debugger/reloader. Each MJPEG client holds one thread while streaming,
+    # so leave room for REST calls next to a few streams. A small output
+    # buffer makes a slow client block its generator (whose ring buffer then
+    # drops old frames) instead of waitress queueing megabytes of JPEGs.
+    serve(app, host="0.0.0.0", port=5000, threads=16, outbuf_high_watermark=1 << 20)
 
 if __name__ == "__main__":
     main()
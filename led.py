@@ -1,29 +1,34 @@
 # led.py
 import time
-import RPi.GPIO as GPIO
+import pigpio
 
 # Sätt True om LED är aktiv-låg (0% = på, 100% = av). False för vanlig aktiv-hög.
 LED_ACTIVE_LOW = False
 LED_PIN = 17
 PWM_FREQ = 1000
 
-pwm = None
+# pigpiod gör PWM:en med DMA i en egen process – Flask-processen skickar bara
+# ett kommando över socketen per ändring, ingen PWM-tråd under GIL:en.
+_pi = None
 ON_DUTY  = 0   if LED_ACTIVE_LOW else 100
 OFF_DUTY = 100 if LED_ACTIVE_LOW else 0
 
 def setup_led():
-    global pwm
-    GPIO.setwarnings(False)
-    GPIO.setmode(GPIO.BCM)
-    GPIO.setup(LED_PIN, GPIO.OUT)
-    pwm = GPIO.PWM(LED_PIN, PWM_FREQ)
-    pwm.start(OFF_DUTY)  # starta släckt
+    global _pi
+    pi = pigpio.pi()
+    if not pi.connected:
+        raise RuntimeError("pigpiod körs inte (sudo systemctl enable --now pigpiod)")
+    pi.set_mode(LED_PIN, pigpio.OUTPUT)
+    pi.set_PWM_frequency(LED_PIN, PWM_FREQ)
+    pi.set_PWM_range(LED_PIN, 100)  # duty i procent, som tidigare
+    pi.set_PWM_dutycycle(LED_PIN, OFF_DUTY)  # starta släckt
+    _pi = pi
 
 def led_on():
-    pwm.ChangeDutyCycle(ON_DUTY)
+    _pi.set_PWM_dutycycle(LED_PIN, ON_DUTY)
 
 def led_off():
-    pwm.ChangeDutyCycle(OFF_DUTY)
+    _pi.set_PWM_dutycycle(LED_PIN, OFF_DUTY)
 
 def led_blink(duration=0.25):
     """Enkel, blockerande blink."""
@@ -32,12 +37,13 @@ def led_blink(duration=0.25):
     led_off()
 
 def cleanup_led():
+    if _pi is None:
+        return
     try:
-        if pwm is not None:
-            pwm.stop()
+        _pi.set_PWM_dutycycle(LED_PIN, OFF_DUTY)
     except Exception:
         pass
     try:
-        GPIO.cleanup()
+        _pi.stop()
     except Exception:
         pass
@@ -2,20 +2,131 @@
 # storage.py – S3 presigned helpers
 
 import os
+import hmac
+import time
 import uuid
+import hashlib
 import mimetypes
+import threading
+from urllib.parse import quote
+from collections import OrderedDict
+from datetime import datetime, timezone
 import boto3
 
 S3_BUCKET = os.getenv("S3_BUCKET", "pi-photos-bucket")
 AWS_REGION = os.getenv("AWS_DEFAULT_REGION", "eu-north-1")
 
-s3 = boto3.client("s3", region_name=AWS_REGION)
+_session = boto3.session.Session(region_name=AWS_REGION)
+s3 = _session.client("s3")
+# Same credentials object the client signs with (RefreshableCredentials for STS/roles)
+_credentials = _session.get_credentials()
+
+# Presigned GET URLs are reused until they have less than PRESIGN_MIN_REMAINING
+# seconds left; the original expiry is kept, never extended.
+VIEW_URL_EXPIRES = 3600
+PRESIGN_MIN_REMAINING = 600
+_PRESIGN_CACHE_MAX = 4096
+_presign_cache = OrderedDict()  # key -> (url, expires_at)
+_presign_lock = threading.Lock()
+
+# GET URLs are signed locally (SigV4 query auth) with a signing key derived
+# once per day instead of going through generate_presigned_url each time.
+_S3_HOST = f"{S3_BUCKET}.s3.{AWS_REGION}.amazonaws.com"
+_signing_key = (None, None)  # ((secret, date), key)
 
 
 def _guess_content_type(filename: str) -> str:
     return mimetypes.guess_type(filename)[0] or "application/octet-stream"
 
 
+def presign_lifetime(expires_in: int) -> int:
+    """Clamp expires_in to what the signing credentials can actually honour.
+
+    A presigned URL stops working when the session token it was signed with
+    expires, whatever ExpiresIn says, so cap the lifetime at what is left.
+    """
+    if getattr(_credentials, "_expiry_time", None) is None:
+        return expires_in  # static keys never expire
+    # botocore refreshes under its own lock once expiry is close
+    _credentials.get_frozen_credentials()
+    remaining = (_credentials._expiry_time - datetime.now(timezone.utc)).total_seconds()
+    return max(1, min(expires_in, int(remaining) - 5))
+
+
+def _hmac(key: bytes, msg: str) -> bytes:
+    return hmac.new(key, msg.encode(), hashlib.sha256).digest()
+
+
+def _get_signing_key(secret: str, date: str) -> bytes:
+    global _signing_key
+    cache_id, key = _signing_key
+    if cache_id != (secret, date):
+        key = _hmac(_hmac(_hmac(_hmac(("AWS4" + secret).encode(), date), AWS_REGION), "s3"), "aws4_request")
+        _signing_key = ((secret, date), key)
+    return key
+
+
+def _sigv4_get_url(host: str, key: str, expires_in: int, creds, now: datetime) -> str:
+    """SigV4 presigned GET URL for key on host (virtual-hosted bucket)."""
+    amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+    date = amz_date[:8]
+    scope = f"{date}/{AWS_REGION}/s3/aws4_request"
+    params = [
+        ("X-Amz-Algorithm", "AWS4-HMAC-SHA256"),
+        ("X-Amz-Credential", f"{creds.access_key}/{scope}"),
+        ("X-Amz-Date", amz_date),
+        ("X-Amz-Expires", str(expires_in)),
+    ]
+    if creds.token:
+        params.append(("X-Amz-Security-Token", creds.token))
+    params.append(("X-Amz-SignedHeaders", "host"))
+    query = "&".join(f"{k}={quote(v, safe='-_.~')}" for k, v in params)
+    path = "/" + quote(key, safe="/-_.~")
+    canonical = f"GET\n{path}\n{query}\nhost:{host}\n\nhost\nUNSIGNED-PAYLOAD"
+    string_to_sign = (
+        f"AWS4-HMAC-SHA256\n{amz_date}\n{scope}\n"
+        + hashlib.sha256(canonical.encode()).hexdigest()
+    )
+    signature = hmac.new(
+        _get_signing_key(creds.secret_key, date), string_to_sign.encode(), hashlib.sha256
+    ).hexdigest()
+    return f"https://{host}{path}?{query}&X-Amz-Signature={signature}"
+
+
+def presigned_get_url(key: str, expires_in: int) -> str:
+    """Presigned GET URL without the boto3 request/endpoint machinery."""
+    if _credentials is None or "." in S3_BUCKET:
+        # No credentials to sign with locally, or a dotted bucket that
+        # can't use virtual-hosted TLS: let boto3 handle it.
+        return s3.generate_presigned_url(
+            ClientMethod="get_object",
+            Params={"Bucket": S3_BUCKET, "Key": key},
+            ExpiresIn=expires_in,
+        )
+    creds = _credentials.get_frozen_credentials()
+    return _sigv4_get_url(_S3_HOST, key, expires_in, creds, datetime.now(timezone.utc))
+
+
+def presign_get(key: str, expires_in: int = VIEW_URL_EXPIRES) -> tuple:
+    """(url, expires_at) for key, served from cache while it is still fresh."""
+    now = time.time()
+    with _presign_lock:
+        hit = _presign_cache.get(key)
+        if hit and now + PRESIGN_MIN_REMAINING <= hit[1]:
+            _presign_cache.move_to_end(key)
+            return hit
+
+    expires_in = presign_lifetime(expires_in)
+    hit = (presigned_get_url(key, expires_in), now + expires_in)
+
+    with _presign_lock:
+        _presign_cache[key] = hit
+        _presign_cache.move_to_end(key)
+        while len(_presign_cache) > _PRESIGN_CACHE_MAX:
+            _presign_cache.popitem(last=False)
+    return hit
+
+
 def create_presigned_upload_url(data: dict) -> dict:
     """Create presigned S3 upload and view URLs."""
     filename = (data or {}).get("filename") or f"{uuid.uuid4()}.bin"
@@ -26,15 +137,11 @@ def create_presigned_upload_url(data: dict) -> dict:
     upload_url = s3.generate_presigned_url(
         ClientMethod="put_object",
         Params={"Bucket": S3_BUCKET, "Key": key, "ContentType": content_type},
-        ExpiresIn=600,   # 10 minutes
+        ExpiresIn=presign_lifetime(600),   # 10 minutes
         HttpMethod="PUT",
     )
 
-    view_url = s3.generate_presigned_url(
-        ClientMethod="get_object",
-        Params={"Bucket": S3_BUCKET, "Key": key},
-        ExpiresIn=3600,  # 1 hour
-    )
+    view_url = presigned_get_url(key, presign_lifetime(VIEW_URL_EXPIRES))  # 1 hour
 
     return {"uploadUrl": upload_url, "key": key, "viewUrl": view_url}
 
@@ -44,25 +151,76 @@ def create_presigned_view_url(data: dict) -> dict:
     key = (data or {}).get("key")
     if not key:
         raise ValueError("Missing 'key'")
-    url = s3.generate_presigned_url(
-        ClientMethod="get_object",
-        Params={"Bucket": S3_BUCKET, "Key": key},
-        ExpiresIn=3600,
-    )
-    return {"url": url}
+    url, expires_at = presign_get(key)
+    return {"url": url, "expiresAt": int(expires_at)}
 
-def list_s3_objects(prefix="users/") -> dict:
-    """List objects in the S3 bucket with optional prefix."""
-    resp = s3.list_objects_v2(Bucket=S3_BUCKET, Prefix=prefix, MaxKeys=100)
-    items = []
-    for o in resp.get("Contents", []):
-        items.append({
-            "key": o["Key"],
-            "size": o.get("Size", 0),
-            "lastModified": o.get("LastModified").isoformat(),
-        })
+LIST_MAX_ITEMS = 1000
+
+
+def _object_item(o) -> dict:
     return {
-        "items": items,
-        "truncated": resp.get("IsTruncated", False)
+        "key": o["Key"],
+        "size": o.get("Size", 0),
+        "lastModified": o.get("LastModified").isoformat(),
     }
 
+
+def iter_s3_pages(prefix="users/", max_items=LIST_MAX_ITEMS):
+    """Yield list_s3_objects-shaped dicts one S3 page at a time, up to max_items objects."""
+    kwargs = {"Bucket": S3_BUCKET, "Prefix": prefix}
+    remaining = max_items
+    while remaining > 0:
+        resp = s3.list_objects_v2(MaxKeys=min(1000, remaining), **kwargs)
+        contents = resp.get("Contents", [])
+        remaining -= len(contents)
+        truncated = resp.get("IsTruncated", False)
+        yield {"items": [_object_item(o) for o in contents], "truncated": truncated}
+        if not truncated:
+            break
+        kwargs["ContinuationToken"] = resp["NextContinuationToken"]
+
+
+# Listings are reused for a short while per prefix; uploads through this
+# server drop the affected prefixes right away (invalidate_listings).
+LIST_CACHE_TTL = 30.0
+_LIST_CACHE_MAX = 128
+_list_cache = OrderedDict()  # prefix -> (monotonic time, pages)
+_list_lock = threading.Lock()
+
+
+def cached_s3_pages(prefix="users/"):
+    """iter_s3_pages served from cache while fresh; a listing is cached once fully read."""
+    with _list_lock:
+        hit = _list_cache.get(prefix)
+        if hit and time.monotonic() - hit[0] < LIST_CACHE_TTL:
+            _list_cache.move_to_end(prefix)
+            pages = hit[1]
+        else:
+            pages = None
+    if pages is not None:
+        yield from pages
+        return
+
+    started = time.monotonic()
+    pages = []
+    for page in iter_s3_pages(prefix):
+        pages.append(page)
+        yield page
+
+    with _list_lock:
+        _list_cache[prefix] = (started, pages)
+        _list_cache.move_to_end(prefix)
+        while len(_list_cache) > _LIST_CACHE_MAX:
+            _list_cache.popitem(last=False)
+
+
+def invalidate_listings(key: str):
+    """Forget cached listings whose prefix covers key."""
+    with _list_lock:
+        for prefix in [p for p in _list_cache if key.startswith(p)]:
+            del _list_cache[prefix]
+
+
+def list_s3_objects(prefix="users/") -> dict:
+    """List objects in the S3 bucket with optional prefix."""
+    return next(iter_s3_pages(prefix, max_items=100))